@@ -0,0 +1,6 @@
+# Run once at deploy time, before the app starts: publishes the trip table
+# in shared memory so every app worker maps the same copy.
+from prep import SHM_ARROW_PATH, write_trip_table
+
+if __name__ == "__main__":
+    write_trip_table(SHM_ARROW_PATH)
@@ -1,91 +1,141 @@
+from datetime import timedelta
 import streamlit as st
-import pandas as pd
 import numpy as np
 import pydeck as pdk
-import plotly.express as px
+
+from prep import (DAY_TO_CODE, WEEK_ORDER, keep_trip_rows, load_prepared, match_stations, route_key, route_rows,
+                  station_position)
+
+MAP_VIEW = pdk.ViewState(latitude=60.1699, longitude=24.9384, zoom=11)
+HOURLY_AXES = {"xaxis": {"title": {"text": "Weekday"}}, "yaxis": {"title": {"text": "Trips"}}}
 
 st.set_page_config(page_title="Helsinki Bike Trips", layout="wide")
 
-@st.cache_data
+@st.cache_resource
 def load_data():
-    df = pd.read_csv("2021-04.csv")
-    if 'Departure' in df.columns:
-        df['Departure'] = pd.to_datetime(df['Departure'], errors='coerce')
+    return load_prepared()
+
+data = load_data()
+df = data.df
+dep_ns, weekday_codes = data.dep_ns, data.weekday_codes
+od_index, od_rows, hour_counts = data.od_index, data.od_rows, data.hour_counts
+duration_sums, distance_sums, distance_counts = data.duration_sums, data.distance_sums, data.distance_counts
+station_ids, lat_e6, lon_e6 = data.station_ids, data.lat_e6, data.lon_e6
+station_search = data.station_search
+first_day, last_day = df['Departure'].min().date(), df['Departure'].max().date()
+
+def covers_month(start_date, end_date):
+    # The per-route tensors hold the whole month, so they only answer queries
+    # whose date range hasn't been narrowed.
+    return start_date <= first_day and end_date >= last_day
+
+def select_trip_rows(dep_station, ret_station, start_date, end_date, weekdays):
+    lo, hi = np.searchsorted(dep_ns, [np.datetime64(start_date, 'ns').view('i8'),
+                                      np.datetime64(end_date + timedelta(days=1), 'ns').view('i8')])
+    weekday_mask = sum(1 << DAY_TO_CODE[day] for day in weekdays)
+    trip_rows = route_rows(od_index, route_key(station_ids, dep_station, ret_station))
+    return keep_trip_rows(trip_rows, weekday_codes, lo, hi, weekday_mask)
+
+# The stats and the chart depend only on the widget values, so flicking
+# back to a combination seen before (e.g. on the hour slider) is a cache
+# hit instead of another filter and figure build.
+@st.cache_data(max_entries=512)
+def trip_summary(dep_station, ret_station, start_date, end_date, weekdays):
+    filtered = df.iloc[select_trip_rows(dep_station, ret_station, start_date, end_date, weekdays)]
+    preview = filtered[['Departure', 'Hour', 'Weekday']].head()
+    if filtered.empty:
+        return 0, "0", "0", preview
+    od_row = od_rows[route_key(station_ids, dep_station, ret_station)]
+    if covers_month(start_date, end_date):
+        days = [DAY_TO_CODE[day] for day in weekdays]
+        avg_duration = duration_sums[od_row, days].sum(dtype=np.float64) / hour_counts[od_row, days].sum()
+        known = distance_counts[od_row, days].sum()
+        avg_distance = distance_sums[od_row, days].sum(dtype=np.float64) / known if known else np.nan
     else:
-        df['Departure'] = pd.NaT
-    df = df[df['Departure'].notna()]
-    df['Weekday'] = df['Departure'].apply(lambda x: x.day_name())
-    df['Hour'] = df['Departure'].apply(lambda x: x.hour)
-    return df
-
-df = load_data()
+        avg_duration = filtered['Duration (sec.)'].mean()
+        avg_distance = filtered['Covered distance (m)'].mean()
+    return len(filtered), f"{(avg_duration / 60):.2f}", f"{(avg_distance / 1000):.2f}", preview
+
+@st.cache_data(max_entries=512)
+def hourly_chart(dep_station, ret_station, start_date, end_date, weekdays, selected_hour):
+    od_row = od_rows[route_key(station_ids, dep_station, ret_station)]
+    if od_row < 0:
+        week_counts = np.zeros(len(WEEK_ORDER), dtype=np.int32)
+    elif covers_month(start_date, end_date):
+        week_counts = hour_counts[od_row, :, selected_hour]
+    else:
+        rows = select_trip_rows(dep_station, ret_station, start_date, end_date, weekdays)
+        hour_data = df.iloc[rows]
+        hour_data = hour_data[hour_data['Hour'] == selected_hour]
+        week_counts = np.bincount(hour_data['Weekday'].cat.codes, minlength=len(WEEK_ORDER))
+
+    # week_counts is already in Monday-Sunday order, so the figure is emitted
+    # as a plain dict rather than going through a DataFrame and px.bar.
+    shown = [day for day in weekdays if week_counts[DAY_TO_CODE[day]] > 0]
+    if not shown:
+        return None
+    return {
+        "data": [{"type": "bar", "x": shown, "y": [int(week_counts[DAY_TO_CODE[day]]) for day in shown]}],
+        "layout": {"title": {"text": f"Trips at {selected_hour}:00 by Weekday"}, **HOURLY_AXES},
+    }
 
 st.title("🚲 Helsinki Bike Trip Explorer")
 
-station_names = df['Departure station name'].dropna().unique()
-station_names.sort()
-
 col1, col2 = st.columns(2)
 
+# Only the best prefix matches for each search go to the browser, not the
+# whole station list.
 with col1:
-    dep_station = st.selectbox("Select Departure Station", station_names)
+    dep_query = st.text_input("Search Departure Station")
+    dep_station = st.selectbox("Select Departure Station", match_stations(station_search, dep_query))
 with col2:
-    ret_station = st.selectbox("Select Return Station", df['Return station name'].dropna().unique())
+    ret_query = st.text_input("Search Return Station")
+    ret_station = st.selectbox("Select Return Station", match_stations(station_search, ret_query))
+
+if dep_station is None or ret_station is None:
+    st.info("No station matches the search.")
+    st.stop()
 
 col3, col4 = st.columns(2)
 
 with col3:
-    start_date = st.date_input("Start Date", df['Departure'].min().date())
+    start_date = st.date_input("Start Date", first_day)
 with col4:
-    end_date = st.date_input("End Date", df['Departure'].max().date())
+    end_date = st.date_input("End Date", last_day)
 
-weekdays = st.multiselect("Select Weekdays", options=df['Weekday'].unique(), default=list(df['Weekday'].unique()))
+weekdays = st.multiselect("Select Weekdays", options=WEEK_ORDER, default=WEEK_ORDER)
+weekdays = tuple(sorted(weekdays, key=DAY_TO_CODE.get))
 
-filtered = df[(df['Departure station name'] == dep_station) &
-              (df['Return station name'] == ret_station) &
-              (df['Departure'].dt.date >= start_date) &
-              (df['Departure'].dt.date <= end_date) &
-              (df['Weekday'].isin(weekdays))]
+trip_count, avg_duration, avg_distance, preview = trip_summary(dep_station, ret_station, start_date, end_date, weekdays)
 
 st.markdown("---")
 
 st.subheader("📊 Trip Stats")
 col5, col6, col7 = st.columns(3)
 
-col5.metric("Total Trips", len(filtered))
-col6.metric("Average Duration (min)", f"{(filtered['Duration (sec.)'].mean() / 60):.2f}" if not filtered.empty else "0")
-col7.metric("Average Distance (km)", f"{(filtered['Covered distance (m)'].mean() / 1000):.2f}" if not filtered.empty else "0")
+col5.metric("Total Trips", trip_count)
+col6.metric("Average Duration (min)", avg_duration)
+col7.metric("Average Distance (km)", avg_distance)
 
 st.markdown("---")
 
 st.subheader("🗺️ Trip Route Map")
 
-station_coords = {}
-np.random.seed(42)
-base_lat, base_lon = 60.1699, 24.9384
-all_stations = df['Departure station name'].dropna().unique().tolist() + df['Return station name'].dropna().unique().tolist()
-
-for name in np.unique(all_stations):
-    lat = base_lat + np.random.normal(0, 0.02)
-    lon = base_lon + np.random.normal(0, 0.03)
-    station_coords[name] = [lat, lon]
-
-if dep_station in station_coords and ret_station in station_coords:
-    dep_coord = station_coords[dep_station]
-    ret_coord = station_coords[ret_station]
+if dep_station in station_ids and ret_station in station_ids:
+    dep_coord = station_position(lat_e6, lon_e6, station_ids[dep_station])
+    ret_coord = station_position(lat_e6, lon_e6, station_ids[ret_station])
 
-    map_df = pd.DataFrame([{
-        "lat": dep_coord[0], "lon": dep_coord[1], "label": "Departure"
-    }, {
-        "lat": ret_coord[0], "lon": ret_coord[1], "label": "Return"
-    }])
+    # pydeck serialises layer data to records anyway, so hand it the records
+    # directly instead of building a DataFrame for two points.
+    map_points = [{"lat": dep_coord[0], "lon": dep_coord[1], "label": "Departure"},
+                  {"lat": ret_coord[0], "lon": ret_coord[1], "label": "Return"}]
 
     st.pydeck_chart(pdk.Deck(
         map_style='mapbox://styles/mapbox/light-v9',
-        initial_view_state=pdk.ViewState(latitude=60.1699, longitude=24.9384, zoom=11),
+        initial_view_state=MAP_VIEW,
         layers=[
             pdk.Layer("ScatterplotLayer",
-                      data=map_df,
+                      data=map_points,
                       get_position='[lon, lat]',
                       get_fill_color='[200, 30, 0, 160]',
                       get_radius=80),
@@ -103,16 +153,11 @@ st.markdown("---")
 
 st.subheader("📅 Hourly Trip Breakdown")
 selected_hour = st.slider("Select Hour of Day", min_value=0, max_value=23, value=8)
-hour_data = filtered[filtered['Hour'] == selected_hour]
+fig = hourly_chart(dep_station, ret_station, start_date, end_date, weekdays, selected_hour)
 
-st.write(filtered[['Departure', 'Hour', 'Weekday']].head())
+st.write(preview)
 
-if not hour_data.empty:
-    chart_data = hour_data.groupby('Weekday').size().reset_index(name='Trips')
-    week_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-    chart_data['Weekday'] = pd.Categorical(chart_data['Weekday'], categories=week_order, ordered=True)
-    chart_data = chart_data.sort_values('Weekday')
-    fig = px.bar(chart_data, x='Weekday', y='Trips', title=f"Trips at {selected_hour}:00 by Weekday")
+if fig is not None:
     st.plotly_chart(fig, use_container_width=True)
 else:
     st.info("No trip data available for this hour and filters.")
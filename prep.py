@@ -0,0 +1,304 @@
+import glob
+import os
+import tempfile
+import zlib
+from functools import lru_cache
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from numba import njit
+from pyarrow import csv as pa_csv
+
+CSV_PATH = "2021-04.csv"
+ARROW_PATH = "2021-04.arrow"
+SHM_ARROW_PATH = "/dev/shm/bikes.arrow"
+# Route tensor caches are named after a checksum of the trips they were
+# binned from, salted with TENSOR_VERSION; bump it when their layout changes.
+TENSOR_PATH = "2021-04.{}.{:08x}.npy"
+TENSOR_VERSION = 3
+TENSOR_NAMES = ('hour_counts', 'duration_sums', 'distance_sums', 'distance_counts')
+WEEK_ORDER = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+DAY_TO_CODE = {day: code for code, day in enumerate(WEEK_ORDER)}
+# Columns and types of the cached trip table. A cache written with any other
+# schema (e.g. by an older revision) is rebuilt rather than trusted.
+TRIP_SCHEMA = pa.schema([('Departure', pa.timestamp('s')),
+                         ('Departure station name', pa.string()),
+                         ('Return station name', pa.string()),
+                         ('Covered distance (m)', pa.float32()),
+                         ('Duration (sec.)', pa.float32())])
+STATION_MATCHES = 20
+# Station positions are stored as int32 micro-degrees from this origin
+# (about 0.1 m of precision).
+COORD_ORIGIN = (60.0, 24.0)
+COORD_SCALE = 1e6
+
+
+class Prepared(NamedTuple):
+    df: pd.DataFrame
+    dep_ns: np.ndarray
+    weekday_codes: np.ndarray
+    station_ids: dict
+    station_search: tuple
+    lat_e6: np.ndarray
+    lon_e6: np.ndarray
+    od_index: tuple
+    od_rows: np.ndarray
+    hour_counts: np.ndarray
+    duration_sums: np.ndarray
+    distance_sums: np.ndarray
+    distance_counts: np.ndarray
+
+
+def _replace_into(path, write):
+    # Have write() fill a temp file private to this process next to path,
+    # then rename it into place. A crash never leaves a truncated cache, and
+    # concurrent cold starts each publish a complete file of their own rather
+    # than rewriting one another has already renamed (or mapped).
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_trip_table(path):
+    # Parse the CSV into an Arrow IPC file, sorted by departure so loading
+    # needs no reordering copy. The file is published via _replace_into(),
+    # so a worker never maps a half-written table.
+    convert_options = pa_csv.ConvertOptions(include_columns=TRIP_SCHEMA.names,
+                                            column_types=dict(zip(TRIP_SCHEMA.names, TRIP_SCHEMA.types)))
+    table = pa_csv.read_csv(CSV_PATH, convert_options=convert_options)
+    table = table.filter(pc.is_valid(table['Departure'])).sort_by('Departure')
+
+    def write(tmp_path):
+        with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    _replace_into(path, write)
+
+
+def _open_trip_table(path):
+    # Map a cached trip table, or return None if it is missing or was
+    # written in a different layout. Date filtering relies on the rows being
+    # sorted by departure, which older caches weren't, so check that too.
+    if not os.path.exists(path):
+        return None
+    table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+    if not table.schema.equals(TRIP_SCHEMA):
+        return None
+    departures = table['Departure'].to_numpy()
+    if np.any(departures[1:] < departures[:-1]):
+        return None
+    return table
+
+
+def _load_trip_table():
+    # init_shm.py publishes the table in shared memory at deploy time so all
+    # workers map one copy; otherwise fall back to a file next to the CSV,
+    # (re)building it when it is missing or stale.
+    for path in (SHM_ARROW_PATH, ARROW_PATH):
+        table = _open_trip_table(path)
+        if table is not None:
+            return table
+    try:
+        write_trip_table(ARROW_PATH)
+    except FileNotFoundError:
+        # Another worker published the table first; use theirs.
+        if not os.path.exists(ARROW_PATH):
+            raise
+    return _open_trip_table(ARROW_PATH)
+
+
+def load_trips():
+    # The raw columns stay views onto the mapped pages rather than copies.
+    df = _load_trip_table().to_pandas(zero_copy_only=True, split_blocks=True, types_mapper=pd.ArrowDtype)
+    # Both station columns share one category index, so a station has the
+    # same code whether it is the departure or the return end of a trip.
+    stations = pd.api.types.union_categoricals([df['Departure station name'].astype('category').values,
+                                                df['Return station name'].astype('category').values],
+                                               sort_categories=True).categories
+    df['Departure station name'] = pd.Categorical(df['Departure station name'], categories=stations)
+    df['Return station name'] = pd.Categorical(df['Return station name'], categories=stations)
+    df['Weekday'] = pd.Categorical.from_codes(df['Departure'].dt.dayofweek.to_numpy('int8'),
+                                              categories=WEEK_ORDER, ordered=True)
+    df['Hour'] = df['Departure'].dt.hour.to_numpy('int8')
+    return df
+
+
+@njit(cache=True)
+def build_od_csr(dep_codes, ret_codes, n_dep, n_ret):
+    # Group row positions by route key dep * n_ret + ret in CSR form: the
+    # rows of route k are indices[indptr[k]:indptr[k + 1]], in row order.
+    # Rows with a missing station (code -1) belong to no route and are left
+    # out; Numba doesn't bounds-check, so they must never reach the arrays.
+    n_rows = dep_codes.shape[0]
+    indptr = np.zeros(n_dep * n_ret + 1, dtype=np.int64)
+    for i in range(n_rows):
+        if dep_codes[i] >= 0 and ret_codes[i] >= 0:
+            indptr[dep_codes[i] * n_ret + ret_codes[i] + 1] += 1
+    for k in range(n_dep * n_ret):
+        indptr[k + 1] += indptr[k]
+    fill = indptr[:-1].copy()
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    for i in range(n_rows):
+        if dep_codes[i] >= 0 and ret_codes[i] >= 0:
+            k = dep_codes[i] * n_ret + ret_codes[i]
+            indices[fill[k]] = i
+            fill[k] += 1
+    return indptr, indices
+
+
+def build_od_index(df):
+    # Row positions of every (departure, return) pair, so selecting a route
+    # doesn't have to scan the whole frame.
+    n_stations = len(df['Departure station name'].cat.categories)
+    return build_od_csr(df['Departure station name'].cat.codes.to_numpy(),
+                        df['Return station name'].cat.codes.to_numpy(), n_stations, n_stations)
+
+
+def route_key(station_ids, dep_station, ret_station):
+    return int(station_ids[dep_station]) * len(station_ids) + int(station_ids[ret_station])
+
+
+def route_rows(od_index, key):
+    indptr, indices = od_index
+    return indices[indptr[key]:indptr[key + 1]]
+
+
+def _save_array(path, array):
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+    _replace_into(path, write)
+
+
+def _trips_checksum(df, od_index):
+    checksum = zlib.crc32(np.int64(TENSOR_VERSION).tobytes())
+    for array in (od_index[0],
+                  df['Departure'].to_numpy('datetime64[ns]'),
+                  df['Covered distance (m)'].to_numpy('float32', na_value=np.nan),
+                  df['Duration (sec.)'].to_numpy('float32')):
+        checksum = zlib.crc32(np.ascontiguousarray(array).tobytes(), checksum)
+    return checksum
+
+
+def _remove_stale_tensors(current_paths):
+    # Each source checksum (or TENSOR_VERSION) gets its own set of files, so
+    # drop the sets the one just written supersedes. Another worker may be
+    # removing them too.
+    stale = (path for name in ('routes', *TENSOR_NAMES)
+             for path in glob.glob(TENSOR_PATH.replace('{:08x}', '*').format(name)))
+    for path in stale:
+        if path not in current_paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def build_route_tensors(df, od_index):
+    # Per (route, weekday, hour) over the whole month: trip count, summed
+    # duration, and summed distance with the number of trips that have one.
+    # Only routes with trips get a slot; od_rows maps a route key to its slot
+    # (-1 if none). Everything is kept on disk, so later launches mmap it
+    # instead of binning every trip again.
+    checksum = _trips_checksum(df, od_index)
+    routes_path, *paths = [TENSOR_PATH.format(name, checksum) for name in ('routes', *TENSOR_NAMES)]
+    if all(os.path.exists(path) for path in [routes_path, *paths]):
+        return np.load(routes_path, mmap_mode='r'), tuple(np.load(path, mmap_mode='r') for path in paths)
+    indptr, indices = od_index
+    sizes = np.diff(indptr)
+    od_rows = np.full(len(sizes), -1, dtype=np.int32)
+    od_rows[sizes > 0] = np.arange(np.count_nonzero(sizes), dtype=np.int32)
+    # Only rows that belong to a route are binned; see build_od_csr().
+    row_od = np.repeat(od_rows[sizes > 0].astype(np.int64), sizes[sizes > 0])
+    cells = ((row_od * len(WEEK_ORDER) + df['Weekday'].cat.codes.to_numpy()[indices]) * 24
+             + df['Hour'].to_numpy()[indices])
+    shape = (np.count_nonzero(sizes), len(WEEK_ORDER), 24)
+    distance = df['Covered distance (m)'].to_numpy('float64', na_value=np.nan)[indices]
+    has_distance = ~np.isnan(distance)
+
+    def binned(cells, weights=None):
+        return np.bincount(cells, weights=weights, minlength=np.prod(shape)).reshape(shape)
+
+    def counted(cells):
+        counts = binned(cells)
+        if counts.max(initial=0) > np.iinfo(np.uint16).max:
+            raise ValueError("trip counts per (route, weekday, hour) no longer fit in uint16")
+        return counts.astype(np.uint16)
+
+    tensors = (counted(cells),
+               binned(cells, df['Duration (sec.)'].to_numpy('float64')[indices]).astype(np.float32),
+               binned(cells[has_distance], distance[has_distance]).astype(np.float32),
+               counted(cells[has_distance]))
+    for path, tensor in zip(paths, tensors):
+        _save_array(path, tensor)
+    # The route map goes last: its presence marks a complete set.
+    _save_array(routes_path, od_rows)
+    _remove_stale_tensors({routes_path, *paths})
+    return od_rows, tensors
+
+
+def build_station_coords(df):
+    # The trip data has no coordinates, so every station gets a fixed jitter
+    # around the city centre. station_ids maps a name to its position in
+    # lat_e6/lon_e6.
+    base_lat, base_lon = 60.1699, 24.9384
+    all_stations = df['Departure station name'].cat.categories
+    rng = np.random.default_rng(42)
+    offsets = rng.normal(size=(len(all_stations), 2)) * np.array([0.02, 0.03])
+    coords = offsets + np.array([base_lat, base_lon])
+    station_ids = {name: np.int16(i) for i, name in enumerate(all_stations.tolist())}
+    lat_e6, lon_e6 = np.round((coords - np.array(COORD_ORIGIN)) * COORD_SCALE).astype(np.int32).T
+    return station_ids, lat_e6, lon_e6
+
+
+def station_position(lat_e6, lon_e6, code):
+    return (float(lat_e6[code]) / COORD_SCALE + COORD_ORIGIN[0],
+            float(lon_e6[code]) / COORD_SCALE + COORD_ORIGIN[1])
+
+
+def build_station_search(station_names):
+    # Casefolded names in sorted order, so a search prefix maps to a
+    # contiguous range found with two binary searches.
+    folded = np.array([name.casefold() for name in station_names])
+    order = np.argsort(folded, kind='stable')
+    return folded[order], np.array(station_names, dtype=object)[order]
+
+
+def match_stations(station_search, query, limit=STATION_MATCHES):
+    folded, names = station_search
+    query = query.strip().casefold()
+    start, stop = np.searchsorted(folded, [query, query + '\U0010ffff'])
+    return names[start:min(stop, start + limit)].tolist()
+
+
+@lru_cache(maxsize=None)
+def load_prepared():
+    df = load_trips()
+    # Trips are sorted by departure, so a date range maps to a contiguous
+    # block of row positions via searchsorted. Weekday codes are tested
+    # against a 7-bit mask of the selected days.
+    dep_ns = df['Departure'].to_numpy('datetime64[ns]').view('i8')
+    weekday_codes = df['Weekday'].cat.codes.to_numpy()
+    station_ids, lat_e6, lon_e6 = build_station_coords(df)
+    station_search = build_station_search(list(station_ids))
+    od_index = build_od_index(df)
+    od_rows, tensors = build_route_tensors(df, od_index)
+    return Prepared(df, dep_ns, weekday_codes, station_ids, station_search, lat_e6, lon_e6,
+                    od_index, od_rows, *tensors)
+
+
+def keep_trip_rows(rows, weekday_codes, lo, hi, weekday_mask):
+    # Date range and weekday tests over one route's rows, folded into a
+    # single reused bool buffer.
+    keep = np.greater_equal(rows, lo)
+    np.logical_and(keep, np.less(rows, hi), out=keep)
+    np.logical_and(keep, (1 << weekday_codes[rows]) & weekday_mask, out=keep)
+    return rows[keep]